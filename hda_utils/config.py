@@ -1,6 +1,15 @@
 # hda_utils/config.py
 from hda import Client, Configuration
+from hda_utils.rate_control import get_rate_controller
 
-def get_client():
+
+class RateLimitedClient(Client):
+    """HDA client whose HTTP attempts, including retries, go through the shared rate controller."""
+
+    def robust(self, call):
+        return super().robust(get_rate_controller().wrap(call))
+
+
+def get_client(retry_max=3, sleep_max=1):
     config = Configuration(path='../.hdarc')
-    return Client(config=config, retry_max=3, sleep_max=1)
+    return RateLimitedClient(config=config, retry_max=retry_max, sleep_max=sleep_max)
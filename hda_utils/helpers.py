@@ -1,9 +1,12 @@
 # hda_utils/helpers.py
 import multiprocessing
+import time
 from hda_utils.config import get_client
+from hda_utils.rate_control import get_rate_controller, set_rate_controller
 
 def search_with_timeout(query, timeout):
-    def target(queue):
+    def target(queue, controller):
+        set_rate_controller(controller)
         c = get_client()
         try:
             result = c.search(query)
@@ -11,14 +14,26 @@ def search_with_timeout(query, timeout):
         except Exception as e:
             queue.put(("error", e))
 
+    controller = get_rate_controller()
     queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=target, args=(queue,))
+    process = multiprocessing.Process(target=target, args=(queue, controller))
+    waited_before = controller.waited()
+    start = time.monotonic()
     process.start()
-    process.join(timeout)
+    # Time spent waiting for rate-limit tokens does not count against the
+    # timeout, up to another `timeout` seconds so the check always ends.
+    while process.is_alive():
+        token_wait = min(controller.waited() - waited_before, timeout)
+        elapsed = time.monotonic() - start - token_wait
+        if elapsed >= timeout:
+            break
+        process.join(min(timeout - elapsed, 1))
 
     if process.is_alive():
         process.terminate()
         process.join()
+        # The worker was most likely killed mid-request
+        controller.forget_process(process.pid)
         raise TimeoutError(f"Dataset check exceeded {timeout} seconds")
 
     if not queue.empty():
@@ -0,0 +1,307 @@
+# hda_utils/rate_control.py
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = ("datasets", "metadata", "search", "other")
+
+# Per endpoint: initial rate and floor (req/s), burst capacity, latency above
+# which the rate is treated as congested (s). A slow search usually means an
+# expensive query rather than an overloaded server, so search keeps a high floor.
+ENDPOINT_LIMITS = {
+    "datasets": {"rate": 2.0, "min_rate": 0.2, "burst": 5.0, "latency_target": 5.0},
+    "metadata": {"rate": 4.0, "min_rate": 0.2, "burst": 8.0, "latency_target": 5.0},
+    "search": {"rate": 2.0, "min_rate": 1.0, "burst": 4.0, "latency_target": 20.0},
+    "other": {"rate": 2.0, "min_rate": 0.2, "burst": 4.0, "latency_target": 10.0},
+}
+
+MAX_RATE = 20.0
+ADDITIVE_INCREASE = 0.1
+MULTIPLICATIVE_DECREASE = 0.5
+# Rates move at most once per window in either direction, so a burst of
+# fast replies cannot undo a cut faster than a burst of errors can make one.
+ADJUST_WINDOW = 1.0
+# Statuses hda's Client.robust retries
+THROTTLE_STATUS = (408, 429, 500, 502, 503, 504)
+# Client.robust also handles 403, but only invalidates the token and gives
+# up. It points at expired or bad credentials, not at load, so it is counted
+# on its own and does not slow the endpoint down.
+AUTH_FAILURE_STATUS = 403
+# Longest pause honoured from a Retry-After header (s)
+MAX_RETRY_AFTER = 60
+# The lock is only held for a few arithmetic operations; failing to get it
+# within this delay means the shared state can no longer be trusted.
+LOCK_TIMEOUT = 5
+
+# Slot layout of each endpoint in the shared array
+(_RATE, _TOKENS, _LAST_REFILL, _BLOCKED_UNTIL, _LAST_DECREASE, _LAST_INCREASE,
+ _THROTTLES, _REQUESTS, _IN_FLIGHT, _WAITED, _AUTH_FAILURES) = range(11)
+_SLOTS = 11
+# In-flight requests are also counted per process, so the requests of a
+# terminated worker can be cleared. Each row holds a pid and one count per
+# endpoint.
+MAX_PROCESSES = 32
+_ROW = 1 + len(ENDPOINTS)
+
+
+# Client.search first calls Client.accept_tac, which requests datasets/<id>
+# and termsaccepted/<id>, so each search also uses the datasets and other
+# buckets.
+def endpoint_from_url(url):
+    if "/dataaccess/search" in url:
+        return "search"
+    if "/dataaccess/queryable" in url:
+        return "metadata"
+    if "/datasets" in url:
+        return "datasets"
+    return "other"
+
+
+def _retry_after_seconds(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class RateController:
+    """Token buckets per HDA endpoint, adjusted with AIMD.
+
+    The state lives in shared memory, so a single controller can be used
+    from several threads and handed to worker processes as a Process argument.
+    """
+
+    def __init__(self, limits=None, events_path=None, run_id=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.limits = limits or ENDPOINT_LIMITS
+        self._clock = clock
+        self._sleep = sleep
+        self.events_path = events_path
+        self.run_id = run_id
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray("d", _SLOTS * len(ENDPOINTS))
+        self._processes = multiprocessing.RawArray("d", _ROW * MAX_PROCESSES)
+        now = self._clock()
+        for endpoint in ENDPOINTS:
+            base = self._base(endpoint)
+            self._state[base + _RATE] = self.limits[endpoint]["rate"]
+            self._state[base + _TOKENS] = self.limits[endpoint]["burst"]
+            self._state[base + _LAST_REFILL] = now
+            self._state[base + _LAST_DECREASE] = float("-inf")
+            self._state[base + _LAST_INCREASE] = float("-inf")
+
+    @contextmanager
+    def _locked(self):
+        # search_with_timeout terminates workers with SIGTERM. A process dying
+        # while holding a multiprocessing lock never releases it, so SIGTERM is
+        # held back until the lock is released.
+        old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            if not self._lock.acquire(timeout=LOCK_TIMEOUT):
+                raise RuntimeError(
+                    f"Rate controller lock not released after {LOCK_TIMEOUT} seconds"
+                )
+            try:
+                yield
+            finally:
+                self._lock.release()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+    def _base(self, endpoint):
+        return ENDPOINTS.index(endpoint) * _SLOTS
+
+    def _process_row(self, pid, claim=False):
+        free = None
+        for row in range(0, len(self._processes), _ROW):
+            if self._processes[row] == pid:
+                return row
+            if free is None and self._processes[row] == 0:
+                free = row
+        if claim and free is not None:
+            self._processes[free] = pid
+            return free
+        return None
+
+    def _refill(self, base, burst, now):
+        elapsed = now - self._state[base + _LAST_REFILL]
+        tokens = self._state[base + _TOKENS] + elapsed * self._state[base + _RATE]
+        self._state[base + _TOKENS] = min(burst, tokens)
+        self._state[base + _LAST_REFILL] = now
+
+    def acquire(self, endpoint):
+        """Waits for a token and returns the number of requests now in flight."""
+        base = self._base(endpoint)
+        burst = self.limits[endpoint]["burst"]
+        while True:
+            with self._locked():
+                now = self._clock()
+                self._refill(base, burst, now)
+                blocked_for = self._state[base + _BLOCKED_UNTIL] - now
+                if blocked_for > 0:
+                    wait = blocked_for
+                elif self._state[base + _TOKENS] >= 1:
+                    self._state[base + _TOKENS] -= 1
+                    self._state[base + _REQUESTS] += 1
+                    self._state[base + _IN_FLIGHT] += 1
+                    row = self._process_row(os.getpid(), claim=True)
+                    if row is not None:
+                        self._processes[row + 1 + ENDPOINTS.index(endpoint)] += 1
+                    return int(self._state[base + _IN_FLIGHT])
+                else:
+                    wait = (1 - self._state[base + _TOKENS]) / self._state[base + _RATE]
+                # Counted before sleeping so callers enforcing a timeout can
+                # discount it while the wait is still going on.
+                self._state[base + _WAITED] += wait
+            self._sleep(wait)
+
+    def release(self, endpoint):
+        with self._locked():
+            self._state[self._base(endpoint) + _IN_FLIGHT] -= 1
+            row = self._process_row(os.getpid())
+            if row is not None:
+                self._processes[row + 1 + ENDPOINTS.index(endpoint)] -= 1
+                if not any(self._processes[row + 1:row + _ROW]):
+                    self._processes[row] = 0
+
+    def forget_process(self, pid):
+        """Clears the in-flight requests of a process that was terminated."""
+        with self._locked():
+            row = self._process_row(pid)
+            if row is None:
+                return
+            for index, endpoint in enumerate(ENDPOINTS):
+                self._state[self._base(endpoint) + _IN_FLIGHT] -= self._processes[row + 1 + index]
+                self._processes[row + 1 + index] = 0
+            self._processes[row] = 0
+
+    def waited(self):
+        """Total seconds spent waiting for tokens, over all endpoints."""
+        with self._locked():
+            return sum(self._state[self._base(endpoint) + _WAITED] for endpoint in ENDPOINTS)
+
+    def _decrease(self, endpoint, reason, detail, retry_after=0.0):
+        base = self._base(endpoint)
+        with self._locked():
+            now = self._clock()
+            self._state[base + _THROTTLES] += 1
+            retry_after = min(retry_after, MAX_RETRY_AFTER)
+            if retry_after > 0:
+                self._state[base + _BLOCKED_UNTIL] = max(
+                    self._state[base + _BLOCKED_UNTIL], now + retry_after
+                )
+            # Responses from requests already in flight report the same
+            # congestion, so only cut the rate once per window.
+            if now - self._state[base + _LAST_DECREASE] >= ADJUST_WINDOW:
+                self._state[base + _RATE] = max(
+                    self.limits[endpoint]["min_rate"],
+                    self._state[base + _RATE] * MULTIPLICATIVE_DECREASE,
+                )
+                self._state[base + _LAST_DECREASE] = now
+            rate = self._state[base + _RATE]
+        self._record_event(endpoint, reason, detail, rate, retry_after)
+
+    def _increase(self, endpoint):
+        base = self._base(endpoint)
+        with self._locked():
+            now = self._clock()
+            if now - self._state[base + _LAST_INCREASE] >= ADJUST_WINDOW:
+                self._state[base + _RATE] = min(
+                    MAX_RATE, self._state[base + _RATE] + ADDITIVE_INCREASE
+                )
+                self._state[base + _LAST_INCREASE] = now
+
+    def _count_auth_failure(self, endpoint):
+        with self._locked():
+            self._state[self._base(endpoint) + _AUTH_FAILURES] += 1
+        logger.warning("HDA refused access to the %s endpoint (403)", endpoint)
+
+    def observe(self, endpoint, status_code, latency, retry_after=0.0, in_flight=1):
+        if status_code in THROTTLE_STATUS:
+            self._decrease(endpoint, "http_status", status_code, retry_after)
+        elif status_code == AUTH_FAILURE_STATUS:
+            self._count_auth_failure(endpoint)
+        elif latency > self.limits[endpoint]["latency_target"]:
+            # With a single request in flight the client already waits for each
+            # reply, so slowing down would not relieve the server.
+            if in_flight > 1:
+                self._decrease(endpoint, "latency", round(latency, 3))
+        elif status_code < 400:
+            self._increase(endpoint)
+
+    def observe_failure(self, endpoint, error):
+        self._decrease(endpoint, "connection_error", str(error))
+
+    def _record_event(self, endpoint, reason, detail, rate, retry_after):
+        event = {
+            "run_id": self.run_id,
+            "time": datetime.utcnow().isoformat(),
+            "endpoint": endpoint,
+            "reason": reason,
+            "detail": detail,
+            "new_rate": round(rate, 3),
+            "retry_after": retry_after,
+        }
+        logger.warning("HDA throttle event: %s", event)
+        if self.events_path:
+            with open(self.events_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(event) + "\n")
+
+    def wrap(self, call):
+        """Wraps a `requests` session call so each attempt is rate limited."""
+        def wrapped(url, *args, **kwargs):
+            endpoint = endpoint_from_url(url)
+            in_flight = self.acquire(endpoint)
+            start = self._clock()
+            try:
+                response = call(url, *args, **kwargs)
+            except Exception as e:
+                self.observe_failure(endpoint, e)
+                raise
+            finally:
+                self.release(endpoint)
+            self.observe(endpoint, response.status_code, self._clock() - start,
+                         _retry_after_seconds(response), in_flight)
+            return response
+
+        return wrapped
+
+    def summary(self):
+        with self._locked():
+            return {
+                endpoint: {
+                    "rate": round(self._state[self._base(endpoint) + _RATE], 3),
+                    "requests": int(self._state[self._base(endpoint) + _REQUESTS]),
+                    "in_flight": int(self._state[self._base(endpoint) + _IN_FLIGHT]),
+                    "throttle_events": int(self._state[self._base(endpoint) + _THROTTLES]),
+                    "auth_failures": int(self._state[self._base(endpoint) + _AUTH_FAILURES]),
+                    "token_wait_seconds": round(self._state[self._base(endpoint) + _WAITED], 3),
+                }
+                for endpoint in ENDPOINTS
+            }
+
+
+_controller = RateController()
+
+
+def get_rate_controller():
+    return _controller
+
+
+def configure_run(run_id, events_path=None):
+    """Tags throttle events with `run_id` and appends them to `events_path`."""
+    _controller.run_id = run_id
+    _controller.events_path = events_path
+
+
+def set_rate_controller(controller):
+    """Installs a controller received from a parent process."""
+    global _controller
+    _controller = controller
@@ -7,6 +7,7 @@ from hda_utils.metadata import get_geographic_boundaries, get_start_and_end_date
 from hda_utils.query_builder import build_query_from_metadata
 from hda_utils.helpers import get_volume_in_Gb, search_with_timeout
 from hda_utils.get_versions import get_versions
+from hda_utils.rate_control import configure_run, get_rate_controller
 from hda_utils.general import get_duration_in_seconds_from_two_utc, get_number_of_datasets_downloaded, default_serializer
 import uuid
 from datetime import datetime
@@ -17,6 +18,7 @@ logging.basicConfig(level=logging.INFO)
 def main():
     
     start_time = datetime.utcnow()
+    configure_run(start_time.isoformat(), 'data/throttle_events.jsonl')
     c = get_client()
     datasets_availability = []
 
@@ -77,7 +79,8 @@ def main():
             "linux_version": versions['linux_version'],
             "hda_version": versions['hda_version'],
             "script_version": versions['script_version']
-        }
+        },
+        "rate_control": get_rate_controller().summary()
     }
 
 
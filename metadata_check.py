@@ -1,11 +1,10 @@
-from hda import Client, Configuration
+from hda_utils.config import get_client
 import pandas as pd
 import logging
 
 logging.getLogger("hda").setLevel("DEBUG")
 
-config = Configuration(path='../.hdarc')
-c = Client(config=config, retry_max=500, sleep_max=2)
+c = get_client(retry_max=500, sleep_max=2)
 
 datasets_availability = []
 
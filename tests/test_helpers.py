@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+pytest.importorskip("hda")
+
+from hda_utils import helpers, rate_control
+from hda_utils.rate_control import RateController
+
+
+class StubClient:
+    """Goes through the rate controller like RateLimitedClient, without HTTP."""
+
+    def __init__(self, duration):
+        self.duration = duration
+
+    def search(self, query):
+        controller = rate_control.get_rate_controller()
+        controller.acquire("search")
+        try:
+            time.sleep(self.duration)
+        finally:
+            controller.release("search")
+        return query["dataset_id"]
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    controller = RateController()
+    monkeypatch.setattr(rate_control, "_controller", controller)
+    return controller
+
+
+def use_stub_client(monkeypatch, duration):
+    monkeypatch.setattr(helpers, "get_client", lambda: StubClient(duration))
+
+
+def test_terminated_worker_does_not_leave_requests_in_flight(controller, monkeypatch):
+    use_stub_client(monkeypatch, duration=30)
+
+    with pytest.raises(TimeoutError):
+        helpers.search_with_timeout({"dataset_id": "EO:MO:DAT:NWSHELF"}, 0.5)
+
+    assert controller.summary()["search"]["in_flight"] == 0
+    assert controller.acquire("search") == 1
+
+
+def test_token_wait_is_not_counted_in_timeout(controller, monkeypatch):
+    use_stub_client(monkeypatch, duration=0)
+    controller.observe("search", 429, 0.1, retry_after=0.8)
+
+    start = time.monotonic()
+    assert helpers.search_with_timeout({"dataset_id": "EO:MO:DAT:NWSHELF"}, 0.5) == "EO:MO:DAT:NWSHELF"
+    assert time.monotonic() - start >= 0.8
+
+
+def test_timeout_still_fires_while_waiting_for_tokens(controller, monkeypatch):
+    use_stub_client(monkeypatch, duration=0)
+    controller.observe("search", 429, 0.1, retry_after=3600)
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        helpers.search_with_timeout({"dataset_id": "EO:MO:DAT:NWSHELF"}, 0.5)
+    assert time.monotonic() - start < 3
+
+
+def test_timeout_fires_on_slow_search(controller, monkeypatch):
+    use_stub_client(monkeypatch, duration=30)
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        helpers.search_with_timeout({"dataset_id": "EO:MO:DAT:NWSHELF"}, 0.5)
+    assert time.monotonic() - start < 2
@@ -0,0 +1,266 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from hda_utils import rate_control
+from hda_utils.rate_control import RateController, endpoint_from_url
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.reason = "reason"
+
+
+def make_controller():
+    clock = FakeClock()
+    return RateController(clock=clock, sleep=clock.sleep), clock
+
+
+def rate(controller, endpoint):
+    return controller.summary()[endpoint]["rate"]
+
+
+@pytest.mark.parametrize("url, endpoint", [
+    ("https://wekeo-broker.prod.wekeo2.eu/databroker/api/v1/dataaccess/search", "search"),
+    ("https://wekeo-broker.prod.wekeo2.eu/databroker/api/v1/dataaccess/queryable/EO:MO:DAT:NWSHELF", "metadata"),
+    ("https://wekeo-broker.prod.wekeo2.eu/databroker/api/v1/datasets", "datasets"),
+    ("https://wekeo-broker.prod.wekeo2.eu/databroker/api/v1/datasets/EO:MO:DAT:NWSHELF", "datasets"),
+    ("https://wekeo-broker.prod.wekeo2.eu/databroker/api/v1/termsaccepted/Copernicus_General_License", "other"),
+])
+def test_endpoint_from_url(url, endpoint):
+    assert endpoint_from_url(url) == endpoint
+
+
+def test_burst_then_refill():
+    controller, clock = make_controller()
+    for _ in range(4):
+        controller.acquire("search")
+        controller.release("search")
+    assert clock.sleeps == []
+
+    controller.acquire("search")
+    assert clock.sleeps == [pytest.approx(0.5)]
+    assert controller.waited() == pytest.approx(0.5)
+
+
+def test_throttle_status_halves_rate_once_per_window():
+    controller, clock = make_controller()
+    controller.observe("search", 503, 0.1)
+    controller.observe("search", 429, 0.1)
+    assert rate(controller, "search") == 1.0
+    assert controller.summary()["search"]["throttle_events"] == 2
+
+    controller.observe("metadata", 408, 0.1)
+    clock.now += rate_control.ADJUST_WINDOW
+    controller.observe("metadata", 500, 0.1)
+    assert rate(controller, "metadata") == 1.0
+
+
+def test_rate_never_drops_below_endpoint_floor():
+    controller, clock = make_controller()
+    for _ in range(10):
+        controller.observe("search", 503, 0.1)
+        clock.now += rate_control.ADJUST_WINDOW
+    assert rate(controller, "search") == rate_control.ENDPOINT_LIMITS["search"]["min_rate"]
+
+
+def test_increase_is_windowed():
+    controller, clock = make_controller()
+    for _ in range(5):
+        controller.observe("datasets", 200, 0.1)
+    assert rate(controller, "datasets") == pytest.approx(2.1)
+
+    clock.now += rate_control.ADJUST_WINDOW
+    controller.observe("datasets", 200, 0.1)
+    assert rate(controller, "datasets") == pytest.approx(2.2)
+
+
+def test_slow_response_only_cuts_rate_under_concurrency():
+    controller, _ = make_controller()
+    controller.observe("search", 200, 25.0, in_flight=1)
+    assert rate(controller, "search") == 2.0
+    assert controller.summary()["search"]["throttle_events"] == 0
+
+    controller.observe("search", 200, 25.0, in_flight=2)
+    assert rate(controller, "search") == 1.0
+
+
+def test_forbidden_is_counted_apart_from_throttling():
+    controller, _ = make_controller()
+    controller.observe("metadata", 403, 0.1)
+    summary = controller.summary()["metadata"]
+    assert summary["rate"] == 4.0
+    assert summary["throttle_events"] == 0
+    assert summary["auth_failures"] == 1
+
+
+def test_retry_after_blocks_endpoint():
+    controller, clock = make_controller()
+    controller.observe("metadata", 429, 0.1, retry_after=7)
+    controller.acquire("metadata")
+    assert clock.sleeps == [pytest.approx(7)]
+    controller.acquire("datasets")
+    assert clock.sleeps == [pytest.approx(7)]
+
+
+def test_retry_after_is_capped():
+    controller, clock = make_controller()
+    controller.observe("search", 429, 0.1, retry_after=3600)
+    controller.acquire("search")
+    assert clock.sleeps == [pytest.approx(rate_control.MAX_RETRY_AFTER)]
+
+
+def test_wrap_observes_every_attempt():
+    controller, _ = make_controller()
+    responses = [FakeResponse(503, {"Retry-After": "2"}), FakeResponse(200)]
+    wrapped = controller.wrap(lambda url, **kwargs: responses.pop(0))
+
+    assert wrapped("https://hda.test/api/v1/dataaccess/search", json={}).status_code == 503
+    assert wrapped("https://hda.test/api/v1/dataaccess/search", json={}).status_code == 200
+    summary = controller.summary()["search"]
+    assert summary["requests"] == 2
+    assert summary["throttle_events"] == 1
+
+
+def test_wrap_records_connection_errors():
+    controller, _ = make_controller()
+
+    def failing_call(url, **kwargs):
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        controller.wrap(failing_call)("https://hda.test/api/v1/datasets")
+    assert rate(controller, "datasets") == 1.0
+
+
+def test_events_carry_run_id(tmp_path, monkeypatch):
+    controller, _ = make_controller()
+    monkeypatch.setattr(rate_control, "_controller", controller)
+    events_path = tmp_path / "throttle_events.jsonl"
+    rate_control.configure_run("2026-10-19T10:00:00", str(events_path))
+
+    controller.observe("search", 503, 0.1)
+    assert '"run_id": "2026-10-19T10:00:00"' in events_path.read_text()
+
+
+def test_rate_limited_client_wraps_every_retry(monkeypatch):
+    pytest.importorskip("hda")
+    from hda import Configuration
+    from hda_utils.config import RateLimitedClient
+
+    controller, _ = make_controller()
+    monkeypatch.setattr(rate_control, "_controller", controller)
+    config = Configuration(url="https://hda.test/api/v1", user="user", password="password")
+    client = RateLimitedClient(config=config, retry_max=5, sleep_max=0)
+    responses = [FakeResponse(503), FakeResponse(502), FakeResponse(200)]
+
+    response = client.robust(lambda url, **kwargs: responses.pop(0))(
+        "https://hda.test/api/v1/dataaccess/search", json={}
+    )
+    assert response.status_code == 200
+    summary = controller.summary()["search"]
+    assert summary["requests"] == 3
+    assert summary["throttle_events"] == 2
+
+
+def test_rate_limited_client_does_not_retry_forbidden(monkeypatch):
+    pytest.importorskip("hda")
+    from hda import Configuration
+    from hda_utils.config import RateLimitedClient
+
+    controller, _ = make_controller()
+    monkeypatch.setattr(rate_control, "_controller", controller)
+    config = Configuration(url="https://hda.test/api/v1", user="user", password="password")
+    client = RateLimitedClient(config=config, retry_max=5, sleep_max=0)
+    responses = [FakeResponse(403), FakeResponse(200)]
+
+    response = client.robust(lambda url, **kwargs: responses.pop(0))(
+        "https://hda.test/api/v1/dataaccess/queryable/EO:MO:DAT:NWSHELF"
+    )
+    assert response.status_code == 403
+    summary = controller.summary()["metadata"]
+    assert summary["requests"] == 1
+    assert summary["auth_failures"] == 1
+    assert summary["throttle_events"] == 0
+
+
+def fast_limits():
+    return {endpoint: dict(limits, rate=1000.0, burst=1000.0)
+            for endpoint, limits in rate_control.ENDPOINT_LIMITS.items()}
+
+
+def throttled_worker(controller):
+    rate_control.set_rate_controller(controller)
+    wrapped = rate_control.get_rate_controller().wrap(lambda url, **kwargs: FakeResponse(503))
+    wrapped("https://hda.test/api/v1/dataaccess/search", json={})
+
+
+def test_worker_process_shares_state():
+    controller = RateController()
+    process = multiprocessing.Process(target=throttled_worker, args=(controller,))
+    process.start()
+    process.join(10)
+
+    summary = controller.summary()["search"]
+    assert process.exitcode == 0
+    assert summary["requests"] == 1
+    assert summary["throttle_events"] == 1
+    assert summary["rate"] == 1.0
+    assert summary["in_flight"] == 0
+
+
+def test_threads_share_tokens():
+    controller = RateController(limits=fast_limits())
+    wrapped = controller.wrap(lambda url, **kwargs: FakeResponse(200))
+
+    def worker():
+        for _ in range(25):
+            wrapped("https://hda.test/api/v1/datasets")
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summary = controller.summary()["datasets"]
+    assert summary["requests"] == 100
+    assert summary["in_flight"] == 0
+
+
+def lock_holder(controller):
+    while True:
+        with controller._locked():
+            time.sleep(0.05)
+
+
+def test_terminating_worker_never_leaves_lock_held():
+    controller = RateController()
+    for _ in range(5):
+        process = multiprocessing.Process(target=lock_holder, args=(controller,))
+        process.start()
+        time.sleep(0.2)
+        process.terminate()
+        process.join(5)
+        assert not process.is_alive()
+
+    start = time.monotonic()
+    controller.summary()
+    assert time.monotonic() - start < 1